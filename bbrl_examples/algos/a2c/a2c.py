@@ -9,52 +9,43 @@ from bbrl import get_arguments, get_class
 from bbrl.workspace import Workspace
 from bbrl.agents import Agents, TemporalAgent
 
-from bbrl.utils.functionalb import gae
-
 import hydra
 
 import torch
-import torch.nn as nn
-
-from bbrl_examples.models.stochastic_actors import TunableVarianceContinuousActor
-from bbrl_examples.models.stochastic_actors import SquashedGaussianActor
-from bbrl_examples.models.stochastic_actors import StateDependentVarianceContinuousActor
-from bbrl_examples.models.stochastic_actors import ConstantVarianceContinuousActor
-from bbrl_examples.models.stochastic_actors import DiscreteActor, BernoulliActor
 
-from bbrl_examples.models.critics import VAgent
+from bbrl_examples.models.actor_critic import SharedAgent, TracedPolicy
+from bbrl_examples.models.shared_models import compile_mlps
+from bbrl_examples.models.losses_jit import compute_losses, warmup_gae_numba
 from bbrl.agents.gymb import AutoResetGymAgent, NoAutoResetGymAgent
 from bbrl_examples.models.loggers import Logger
+from bbrl_examples.models.optimizers import create_optimizer
 from bbrl.utils.chrono import Chrono
 
-from bbrl.visu.visu_policies import plot_policy
-from bbrl.visu.visu_critics import plot_critic
-
 # HYDRA_FULL_ERROR = 1
 
-import matplotlib
-
-matplotlib.use("TkAgg")
-
 
 # Create the A2C Agent
 def create_a2c_agent(cfg, train_env_agent, eval_env_agent):
     obs_size, act_size = train_env_agent.get_obs_and_actions_sizes()
-    action_agent = globals()[cfg.algorithm.actor_type](
-        obs_size, cfg.algorithm.architecture.actor_hidden_size, act_size
+    # The actor and the critic share their first layer and are computed in one pass
+    action_agent = SharedAgent(
+        obs_size,
+        cfg.algorithm.architecture.actor_hidden_size,
+        cfg.algorithm.architecture.critic_hidden_size,
+        act_size,
+        train_env_agent.is_continuous_action(),
+        cfg.algorithm.actor_type,
     )
+    compile_mlps(action_agent, dynamic=False)
+
     tr_agent = Agents(train_env_agent, action_agent)
     ev_agent = Agents(eval_env_agent, action_agent)
 
-    critic_agent = TemporalAgent(
-        VAgent(obs_size, cfg.algorithm.architecture.critic_hidden_size)
-    )
-
     # Get an agent that is executed on a complete workspace
     train_agent = TemporalAgent(tr_agent)
     eval_agent = TemporalAgent(ev_agent)
     train_agent.seed(cfg.algorithm.seed)
-    return train_agent, eval_agent, critic_agent
+    return train_agent, eval_agent, action_agent
 
 
 def make_gym_env(env_name):
@@ -62,36 +53,17 @@ def make_gym_env(env_name):
 
 
 # Configure the optimizer over the a2c agent
-def setup_optimizers(cfg, action_agent, critic_agent):
-    optimizer_args = get_arguments(cfg.optimizer)
-    parameters = nn.Sequential(action_agent, critic_agent).parameters()
-    optimizer = get_class(cfg.optimizer)(parameters, **optimizer_args)
-    return optimizer
-
-
-def compute_advantages_loss(cfg, reward, must_bootstrap, v_value):
-    # Compute temporal difference
-    # target = reward[:-1] + cfg.algorithm.discount_factor * v_value[1:].detach() * must_bootstrap.int()
-    # td = target - v_value[:-1]
-    advantages = gae(
-        v_value,
-        reward,
-        must_bootstrap,
-        cfg.algorithm.discount_factor,
-        cfg.algorithm.gae,
-    )
-    # Compute critic loss
-    td_error = advantages**2
-    critic_loss = td_error.mean()
-    return critic_loss, advantages
-
-
-def compute_actor_loss(action_logp, td):
-    a2c_loss = action_logp[:-1] * td.detach()
-    return a2c_loss.mean()
+def setup_optimizers(cfg, parameters):
+    return create_optimizer(cfg.optimizer, parameters)
 
 
 def run_a2c(cfg):
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_bf16_reduced_precision_reduction = True
+    # Compile the numba GAE kernels before the first epoch
+    warmup_gae_numba()
+
     # 1)  Build the  logger
     chrono = Chrono()
     logger = Logger(cfg)
@@ -112,101 +84,113 @@ def run_a2c(cfg):
     )
 
     # 3) Create the A2C Agent
-    a2c_agent, eval_agent, critic_agent = create_a2c_agent(
+    a2c_agent, eval_agent, shared_agent = create_a2c_agent(
         cfg, train_env_agent, eval_env_agent
     )
+    # Traced once, used to plot the policy
+    traced_policy = TracedPolicy(shared_agent)
 
     # 5) Configure the workspace to the right dimension
     # Note that no parameter is needed to create the workspace.
-    # In the training loop, calling the agent() and critic_agent()
+    # In the training loop, calling the agent()
     # will take the workspace as parameter
     train_workspace = Workspace()  # Used for training
+    eval_workspace = Workspace()  # Used for evaluation, cleared before each use
 
     # 6) Configure the optimizer over the a2c agent
-    optimizer = setup_optimizers(cfg, a2c_agent, critic_agent)
+    # The parameter list is built once and reused for gradient clipping
+    parameters = list(a2c_agent.parameters())
+    optimizer = setup_optimizers(cfg, parameters)
     nb_steps = 0
     tmp_steps = 0
 
+    device_type = parameters[0].device.type
+    bf16_rollouts = cfg.bf16_rollouts
+
+    # Read the hyper-parameters used at each epoch from the config only once
+    discount_factor = float(cfg.algorithm.discount_factor)
+    gae_coef = float(cfg.algorithm.gae)
+    critic_coef = float(cfg.algorithm.critic_coef)
+    entropy_coef = float(cfg.algorithm.entropy_coef)
+    a2c_coef = float(cfg.algorithm.a2c_coef)
+    max_grad_norm = float(cfg.algorithm.max_grad_norm)
+
     # 7) Training loop
     for epoch in range(cfg.algorithm.max_epochs):
         # Execute the agent in the workspace
-        if epoch > 0:
-            train_workspace.zero_grad()
-            train_workspace.copy_n_last_steps(1)
-            a2c_agent(
-                train_workspace,
-                t=1,
-                n_steps=cfg.algorithm.n_steps - 1,
-                stochastic=True,
-                predict_proba=False,
-                compute_entropy=True,
-            )
-        else:
-            a2c_agent(
-                train_workspace,
-                t=0,
-                n_steps=cfg.algorithm.n_steps,
-                stochastic=True,
-                predict_proba=False,
-                compute_entropy=True,
-            )
-
-        # Compute the critic value over the whole workspace
-        critic_agent(train_workspace, n_steps=cfg.algorithm.n_steps)
-
-        transition_workspace = train_workspace.get_transitions()
-
-        v_value, done, truncated, reward, action, action_logp = transition_workspace[
+        # The rollout may run in bfloat16 (bf16_rollouts). Its forward pass is also
+        # the one the losses are computed from, so backward() then goes through
+        # bfloat16 activations: only the weights and the optimizer stay in float32
+        with torch.autocast(device_type, torch.bfloat16, enabled=bf16_rollouts):
+            if epoch > 0:
+                train_workspace.zero_grad()
+                train_workspace.copy_n_last_steps(1)
+                # The critic value of the first step was copied from the previous epoch
+                shared_agent(train_workspace, t=0, critic_only=True)
+                a2c_agent(
+                    train_workspace,
+                    t=1,
+                    n_steps=cfg.algorithm.n_steps - 1,
+                    stochastic=True,
+                    predict_proba=False,
+                    compute_entropy=True,
+                )
+            else:
+                a2c_agent(
+                    train_workspace,
+                    t=0,
+                    n_steps=cfg.algorithm.n_steps,
+                    stochastic=True,
+                    predict_proba=False,
+                    compute_entropy=True,
+                )
+
+        # The losses are computed on the workspace tensors themselves,
+        # the pairs of consecutive steps are taken by slicing them
+        v_value, done, truncated, reward, action_logp = train_workspace[
             "v_value",
             "env/done",
             "env/truncated",
             "env/reward",
-            "action",
             "action_logprobs",
         ]
-        # print("action", action)
-        nb_steps += action[0].shape[0]
-        # Determines whether values of the critic should be propagated
-        # True if the episode reached a time limit or if the task was not done
-        # See https://colab.research.google.com/drive/1erLbRKvdkdDy0Zn1X_JhC01s1QAt4BBj?usp=sharing
-        must_bootstrap = torch.logical_or(~done[1], truncated[1])
-
-        # Compute critic loss
-        critic_loss, advantages = compute_advantages_loss(
-            cfg, reward, must_bootstrap, v_value
+        # Each step which does not end an episode starts a transition
+        nb_steps += int((~done[:-1]).sum())
+
+        # Compute the critic, actor and entropy losses and the total loss
+        critic_loss, a2c_loss, entropy_loss, loss = compute_losses(
+            done,
+            truncated,
+            v_value,
+            reward,
+            action_logp,
+            train_workspace["entropy"],
+            discount_factor,
+            gae_coef,
+            critic_coef,
+            entropy_coef,
+            a2c_coef,
         )
-        a2c_loss = compute_actor_loss(action_logp, advantages)
-
-        # Compute entropy loss
-        entropy_loss = torch.mean(train_workspace["entropy"])
 
         # Store the losses for tensorboard display
         logger.log_losses(nb_steps, critic_loss, entropy_loss, a2c_loss)
 
-        # Compute the total loss
-        loss = (
-            cfg.algorithm.critic_coef * critic_loss
-            - cfg.algorithm.entropy_coef * entropy_loss
-            - cfg.algorithm.a2c_coef * a2c_loss
-        )
-
         optimizer.zero_grad()
         loss.backward()
-        torch.nn.utils.clip_grad_norm_(
-            a2c_agent.parameters(), cfg.algorithm.max_grad_norm
-        )
+        torch.nn.utils.clip_grad_norm_(parameters, max_grad_norm, foreach=True)
         optimizer.step()
 
         if nb_steps - tmp_steps > cfg.algorithm.eval_interval:
             tmp_steps = nb_steps
-            eval_workspace = Workspace()  # Used for evaluation
-            eval_agent(
-                eval_workspace,
-                t=0,
-                stop_variable="env/done",
-                stochastic=False,
-                predict_proba=False,
-            )
+            eval_workspace.clear()
+            with torch.autocast(device_type, torch.bfloat16, enabled=bf16_rollouts):
+                eval_agent(
+                    eval_workspace,
+                    t=0,
+                    stop_variable="env/done",
+                    stochastic=False,
+                    predict_proba=False,
+                )
             rewards = eval_workspace["env/cumulated_reward"][-1]
             mean = rewards.mean()
             logger.log_reward_losses(rewards, nb_steps)
@@ -225,10 +209,17 @@ def run_a2c(cfg):
                 )
                 policy = eval_agent.agent.agents[1]
                 policy.save_model(filename)
-                critic = critic_agent.agent
                 if cfg.plot_agents:
+                    # The plots are only saved to disk: matplotlib and the plotting
+                    # functions are loaded when needed, with a non-interactive backend
+                    import matplotlib
+
+                    matplotlib.use("Agg")
+                    from bbrl.visu.visu_policies import plot_policy
+                    from bbrl.visu.visu_critics import plot_critic
+
                     plot_policy(
-                        policy,
+                        traced_policy,
                         eval_env_agent,
                         "./a2c_plots/",
                         cfg.gym_env.env_name,
@@ -236,7 +227,7 @@ def run_a2c(cfg):
                         stochastic=False,
                     )
                     plot_critic(
-                        critic,
+                        policy,
                         eval_env_agent,
                         "./a2c_plots/",
                         cfg.gym_env.env_name,
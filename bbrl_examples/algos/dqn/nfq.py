@@ -4,6 +4,7 @@ import os
 import copy
 
 import torch
+import torch.nn.functional as F
 import gym
 import my_gym
 import hydra
@@ -20,13 +21,22 @@ from bbrl.visu.visu_critics import plot_critic
 
 from bbrl_examples.models.exploration_agents import EGreedyActionSelector
 from bbrl_examples.models.critics import DiscreteQAgent
+from bbrl_examples.models.shared_models import maybe_compile
 from bbrl.agents.gymb import AutoResetGymAgent, NoAutoResetGymAgent
-from bbrl_examples.models.loggers import Logger, RewardLogger
+from bbrl_examples.models.loggers import BufferedLog, Logger, RewardLogger
 from bbrl_examples.models.plotters import Plotter
 from bbrl.utils.chrono import Chrono
 
 # HYDRA_FULL_ERROR = 1
 
+# Number of values of the critic loss and of the evaluation reward
+# kept on the device between two writes to the logger
+LOSS_LOG_INTERVAL = 100
+REWARD_LOG_INTERVAL = 10
+
+# The variables of the transitions used by the critic update
+TRANSITION_KEYS = ("env/env_obs", "env/done", "env/truncated", "env/reward", "action")
+
 
 # Create the NFQ Agent
 def create_nfq_agent(cfg, train_env_agent, eval_env_agent):
@@ -37,6 +47,8 @@ def create_nfq_agent(cfg, train_env_agent, eval_env_agent):
     obs_size, act_size = train_env_agent.get_obs_and_actions_sizes()
     critic = DiscreteQAgent(obs_size, cfg.algorithm.architecture.hidden_size, act_size)
     target_critic = copy.deepcopy(critic)
+    # Compiled for the training and the evaluation environments before the first epoch
+    critic.compile_forward(obs_size, cfg.algorithm.n_envs, cfg.algorithm.nb_evals)
     explorer = EGreedyActionSelector(cfg.algorithm.epsilon_init)
     q_agent = TemporalAgent(critic)
     target_q_agent = TemporalAgent(target_critic)
@@ -62,17 +74,70 @@ def setup_optimizers(cfg, q_agent):
     return optimizer
 
 
-def compute_critic_loss(cfg, reward, must_bootstrap, q_values, action):
+def compute_critic_loss(discount_factor, reward, must_bootstrap, q_values, action):
+    """
+    Squared TD error of the critic over the [n_steps, batch_size] transitions
+    Traced within the compiled train step, the target and the error fuse into a few kernels
+    """
     # Compute temporal difference
-    max_q = q_values[1].max(-1)[0].detach()
-    target = reward[:-1] + cfg.algorithm.discount_factor * max_q * must_bootstrap.int()
-    act = action[0].unsqueeze(-1)
-    qvals = torch.gather(q_values[0], dim=1, index=act).squeeze()
-    td = target - qvals
+    next_q = q_values[1:].max(dim=-1).values
+    target = reward[:-1] + discount_factor * next_q * must_bootstrap.float()
+    cur_q = q_values[:-1].gather(-1, action[:-1].unsqueeze(-1)).squeeze(-1)
     # Compute critic loss
-    td_error = td**2
-    critic_loss = td_error.mean()
-    return critic_loss
+    return F.mse_loss(cur_q, target.detach())
+
+
+def get_transitions(train_workspace):
+    """
+    Returns a workspace with the [2, n_transitions] pairs of successive steps
+    of the training workspace, as train_workspace.get_transitions() does,
+    but restricted to TRANSITION_KEYS rather than copying every variable
+    The transitions from the end of an episode to the start of the next one are removed
+    """
+    keep = ~train_workspace["env/done"][:-1].bool()
+    transition_workspace = Workspace()
+    for key in TRANSITION_KEYS:
+        array = train_workspace[key]
+        transition_workspace.set_full(
+            key, torch.stack([array[:-1][keep], array[1:][keep]])
+        )
+    return transition_workspace
+
+
+def make_train_step(cfg, critic, optimizer):
+    """
+    Returns the function updating the critic on a batch of transitions
+    The forward pass of the critic over the batch and the loss are compiled into a single graph
+    (captured in a CUDA graph when the critic is on the GPU)
+    """
+    parameters = list(critic.parameters())
+    discount_factor = float(cfg.algorithm.discount_factor)
+    max_grad_norm = float(cfg.algorithm.max_grad_norm)
+
+    def critic_loss_fn(obs, done, truncated, reward, action):
+        # The critic is run on both steps of the transitions at once
+        q_values = critic.model(obs).squeeze(-1)
+
+        # Determines whether values of the critic should be propagated
+        # True if the episode reached a time limit or if the task was not done
+        # See https://colab.research.google.com/drive/1erLbRKvdkdDy0Zn1X_JhC01s1QAt4BBj?usp=sharing
+        must_bootstrap = ~done[1:] | truncated[1:]
+        return compute_critic_loss(
+            discount_factor, reward, must_bootstrap, q_values, action
+        )
+
+    mode = "reduce-overhead" if parameters[0].is_cuda else None
+    critic_loss_fn = maybe_compile(critic_loss_fn, mode=mode, dynamic=False)
+
+    def train_step(obs, done, truncated, reward, action):
+        critic_loss = critic_loss_fn(obs, done, truncated, reward, action)
+        optimizer.zero_grad()
+        critic_loss.backward()
+        torch.nn.utils.clip_grad_norm_(parameters, max_grad_norm, foreach=True)
+        optimizer.step()
+        return critic_loss
+
+    return train_step
 
 
 def run_dqn(cfg, reward_logger):
@@ -105,8 +170,11 @@ def run_dqn(cfg, reward_logger):
 
     # 6) Configure the optimizer
     optimizer = setup_optimizers(cfg, q_agent)
+    train_step = make_train_step(cfg, q_agent.agent, optimizer)
     nb_steps = 0
     tmp_steps = 0
+    loss_log = BufferedLog(logger, "critic_loss", LOSS_LOG_INTERVAL)
+    reward_log = BufferedLog(logger, "reward", REWARD_LOG_INTERVAL)
 
     # 7) Training loop
     for epoch in range(cfg.algorithm.max_epochs):
@@ -122,37 +190,20 @@ def run_dqn(cfg, reward_logger):
                 train_workspace, t=0, n_steps=cfg.algorithm.n_steps, stochastic=True
             )
 
-        transition_workspace = train_workspace.get_transitions()
+        transition_workspace = get_transitions(train_workspace)
         action = transition_workspace["action"]
         nb_steps += action[0].shape[0]
         rb.put(transition_workspace)
 
         rb_workspace = rb.get_shuffled(cfg.algorithm.batch_size)
 
-        # The q agent needs to be executed on the rb_workspace workspace (gradients are removed in workspace).
-        q_agent(rb_workspace, t=0, n_steps=2, choose_action=False)
-
-        q_values, done, truncated, reward, action = rb_workspace[
-            "q_values", "env/done", "env/truncated", "env/reward", "action"
-        ]
-
-        # Determines whether values of the critic should be propagated
-        # True if the episode reached a time limit or if the task was not done
-        # See https://colab.research.google.com/drive/1erLbRKvdkdDy0Zn1X_JhC01s1QAt4BBj?usp=sharing
-        must_bootstrap = torch.logical_or(~done[1], truncated[1])
+        obs, done, truncated, reward, action = rb_workspace[TRANSITION_KEYS]
 
-        # Compute critic loss
-        critic_loss = compute_critic_loss(cfg, reward, must_bootstrap, q_values, action)
+        # Compute the critic loss and update the critic
+        critic_loss = train_step(obs, done, truncated, reward, action)
 
         # Store the loss for tensorboard display
-        logger.add_log("critic_loss", critic_loss, nb_steps)
-
-        optimizer.zero_grad()
-        critic_loss.backward()
-        torch.nn.utils.clip_grad_norm_(
-            q_agent.parameters(), cfg.algorithm.max_grad_norm
-        )
-        optimizer.step()
+        loss_log.add(critic_loss, nb_steps)
 
         if nb_steps - tmp_steps > cfg.algorithm.eval_interval:
             tmp_steps = nb_steps
@@ -162,8 +213,7 @@ def run_dqn(cfg, reward_logger):
             )
             rewards = eval_workspace["env/cumulated_reward"][-1]
             mean = rewards.mean()
-            logger.add_log("reward", mean, nb_steps)
-            print(f"epoch: {epoch}, reward: {mean}")
+            reward_log.add(mean, nb_steps)
             reward_logger.add(nb_steps, mean)
             if cfg.save_best and mean > best_reward:
                 best_reward = mean
@@ -190,6 +240,9 @@ def run_dqn(cfg, reward_logger):
                         best_reward,
                     )
 
+    loss_log.flush()
+    reward_log.flush()
+
 
 def main_loop(cfg):
     chrono = Chrono()
@@ -1,62 +1,50 @@
 import sys
 import os
-import copy
 
 import torch
-import torch.nn as nn
 import gym
 import bbrl_gym
 import hydra
 
 from omegaconf import DictConfig
-from bbrl import get_arguments, get_class
 from bbrl.workspace import Workspace
 from bbrl.agents import Agents, TemporalAgent
 
-from bbrl.utils.functionalb import gae
-
-from bbrl.visu.visu_policies import plot_policy
-from bbrl.visu.visu_critics import plot_critic
-
-from bbrl_examples.models.critics import VAgent
-from bbrl_examples.models.actors import TunableVarianceContinuousActor
-from bbrl_examples.models.actors import DiscreteActor
+from bbrl_examples.models.actor_critic import SharedAgent, TracedPolicy
+from bbrl_examples.models.losses_jit import (
+    compute_advantages_loss,
+    compute_ppo_actor_loss,
+    warmup_gae_numba,
+)
+from bbrl_examples.models.shared_models import compile_mlps
 from bbrl_examples.models.loggers import Logger
+from bbrl_examples.models.optimizers import create_optimizer
 
 from bbrl_examples.models.envs import create_env_agents
 
 # HYDRA_FULL_ERROR = 1
 
-import matplotlib
-
-matplotlib.use("TkAgg")
-
 
 # Create the PPO Agent
 def create_ppo_agent(cfg, train_env_agent, eval_env_agent):
     obs_size, act_size = train_env_agent.get_obs_and_actions_sizes()
-    if train_env_agent.is_continuous_action():
-        action_agent = TunableVarianceContinuousActor(
-            obs_size, cfg.algorithm.architecture.actor_hidden_size, act_size
-        )
-    else:
-        action_agent = DiscreteActor(
-            obs_size, cfg.algorithm.architecture.actor_hidden_size, act_size
-        )
+    # The actor and the critic share their first layer and are computed in one pass
+    action_agent = SharedAgent(
+        obs_size,
+        cfg.algorithm.architecture.actor_hidden_size,
+        cfg.algorithm.architecture.critic_hidden_size,
+        act_size,
+        train_env_agent.is_continuous_action(),
+    )
+    compile_mlps(action_agent, dynamic=False)
+
     tr_agent = Agents(train_env_agent, action_agent)
     ev_agent = Agents(eval_env_agent, action_agent)
 
-    critic_agent = TemporalAgent(
-        VAgent(obs_size, cfg.algorithm.architecture.critic_hidden_size)
-    )
-
     train_agent = TemporalAgent(tr_agent)
     eval_agent = TemporalAgent(ev_agent)
     train_agent.seed(cfg.algorithm.seed)
-
-    old_policy = copy.deepcopy(action_agent)
-    old_critic_agent = copy.deepcopy(critic_agent)
-    return train_agent, eval_agent, critic_agent, old_policy, old_critic_agent
+    return train_agent, eval_agent, action_agent
 
 
 def make_gym_env(env_name):
@@ -67,36 +55,17 @@ def make_gym_env(env_name):
 
 
 # Configure the optimizer
-def setup_optimizer(cfg, action_agent, critic_agent):
-    optimizer_args = get_arguments(cfg.optimizer)
-    parameters = nn.Sequential(action_agent, critic_agent).parameters()
-    optimizer = get_class(cfg.optimizer)(parameters, **optimizer_args)
-    return optimizer
-
-
-def compute_advantage_loss(cfg, reward, must_bootstrap, v_value):
-    # Compute temporal difference with GAE
-    advantages = gae(
-        v_value,
-        reward,
-        must_bootstrap,
-        cfg.algorithm.discount_factor,
-        cfg.algorithm.gae,
-    )
-    # Compute critic loss
-    td_error = advantages**2
-    critic_loss = td_error.mean()
-    return critic_loss, advantages
-
-
-def compute_actor_loss(advantages, ratio, clip_range):
-    actor_loss_1 = advantages * ratio
-    actor_loss_2 = advantages * torch.clamp(ratio, 1 - clip_range, 1 + clip_range)
-    actor_loss = torch.min(actor_loss_1, actor_loss_2).mean()
-    return actor_loss
+def setup_optimizer(cfg, parameters):
+    return create_optimizer(cfg.optimizer, parameters)
 
 
 def run_ppo(cfg):
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_bf16_reduced_precision_reduction = True
+    # Compile the numba GAE kernels before the first epoch
+    warmup_gae_numba()
+
     # 1)  Build the  logger
     logger = Logger(cfg)
     best_reward = -10e9
@@ -104,108 +73,104 @@ def run_ppo(cfg):
     # 2) Create the environment agent
     train_env_agent, eval_env_agent = create_env_agents(cfg)
 
-    (
-        train_agent,
-        eval_agent,
-        critic_agent,
-        old_policy,
-        old_critic_agent,
-    ) = create_ppo_agent(cfg, train_env_agent, eval_env_agent)
-    old_train_agent = TemporalAgent(old_policy)
+    train_agent, eval_agent, shared_agent = create_ppo_agent(
+        cfg, train_env_agent, eval_env_agent
+    )
+    # Traced once, used to plot the policy
+    traced_policy = TracedPolicy(shared_agent)
     train_workspace = Workspace()
+    eval_workspace = Workspace()  # Used for evaluation, cleared before each use
 
     # Configure the optimizer
-    optimizer = setup_optimizer(cfg, train_agent, critic_agent)
+    # The parameter list is built once and reused for gradient clipping
+    parameters = list(train_agent.parameters())
+    optimizer = setup_optimizer(cfg, parameters)
     nb_steps = 0
     tmp_steps = 0
 
+    device_type = parameters[0].device.type
+    bf16_rollouts = cfg.bf16_rollouts
+
+    # Read the hyper-parameters used at each epoch from the config only once
+    discount_factor = float(cfg.algorithm.discount_factor)
+    gae_coef = float(cfg.algorithm.gae)
+    clip_range = float(cfg.algorithm.clip_range)
+    clip_range_vf = float(cfg.algorithm.clip_range_vf)
+    critic_coef = float(cfg.algorithm.critic_coef)
+    actor_coef = float(cfg.algorithm.actor_coef)
+    entropy_coef = float(cfg.algorithm.entropy_coef)
+    max_grad_norm = float(cfg.algorithm.max_grad_norm)
+
     # Training loop
     for epoch in range(cfg.algorithm.max_epochs):
         # Execute the agent in the workspace
-        if epoch > 0:
-            train_workspace.zero_grad()
-            train_workspace.copy_n_last_steps(1)
-            train_agent(
-                train_workspace,
-                t=1,
-                n_steps=cfg.algorithm.n_steps - 1,
-                stochastic=True,
-                predict_proba=False,
-                compute_entropy=True,
-            )
-            old_train_agent(
-                train_workspace,
-                t=1,
-                n_steps=cfg.algorithm.n_steps - 1,
-                stochastic=True,
-                predict_proba=True,
-                compute_entropy=True,
-            )
-        else:
-            train_agent(
-                train_workspace,
-                t=0,
-                n_steps=cfg.algorithm.n_steps,
-                stochastic=True,
-                predict_proba=False,
-                compute_entropy=True,
-            )
-            old_train_agent(
-                train_workspace,
-                t=0,
-                n_steps=cfg.algorithm.n_steps,
-                stochastic=True,
-                predict_proba=True,
-                compute_entropy=True,
-            )
-
-        # Compute the critic value over the whole workspace
-        critic_agent(train_workspace, n_steps=cfg.algorithm.n_steps)
-
-        transition_workspace = train_workspace.get_transitions()
+        # The rollout may run in bfloat16 (bf16_rollouts). Its forward pass is also
+        # the one the losses are computed from, so backward() then goes through
+        # bfloat16 activations: only the weights and the optimizer stay in float32
+        with torch.autocast(device_type, torch.bfloat16, enabled=bf16_rollouts):
+            if epoch > 0:
+                train_workspace.zero_grad()
+                train_workspace.copy_n_last_steps(1)
+                # The critic value of the first step was copied from the previous epoch
+                shared_agent(train_workspace, t=0, critic_only=True)
+                train_agent(
+                    train_workspace,
+                    t=1,
+                    n_steps=cfg.algorithm.n_steps - 1,
+                    stochastic=True,
+                    predict_proba=False,
+                    compute_entropy=True,
+                )
+            else:
+                train_agent(
+                    train_workspace,
+                    t=0,
+                    n_steps=cfg.algorithm.n_steps,
+                    stochastic=True,
+                    predict_proba=False,
+                    compute_entropy=True,
+                )
 
-        done, truncated, reward, action, action_logp, v_value = transition_workspace[
+        # The losses are computed on the workspace tensors themselves,
+        # the pairs of consecutive steps are taken by slicing them
+        done, truncated, reward, action_logp, v_value = train_workspace[
             "env/done",
             "env/truncated",
             "env/reward",
-            "action",
             "action_logprobs",
             "v_value",
         ]
 
-        nb_steps += action[0].shape[0]
+        # Each step which does not end an episode starts a transition
+        nb_steps += int((~done[:-1]).sum())
 
-        # Determines whether values of the critic should be propagated
-        # True if the episode reached a time limit or if the task was not done
-        # See https://colab.research.google.com/drive/1erLbRKvdkdDy0Zn1X_JhC01s1QAt4BBj?usp=sharing
-        must_bootstrap = torch.logical_or(~done[1], truncated[1])
-
-        with torch.no_grad():
-            old_critic_agent(train_workspace, n_steps=cfg.algorithm.n_steps)
-        old_action_logp = transition_workspace["logprob_predict"]
-        old_v_value = transition_workspace["v_value"]
+        # The rollout was generated by the current policy and critic,
+        # so their outputs are also the old log-probabilities and values
+        old_action_logp = action_logp.detach()
+        old_v_value = v_value.detach()
 
         act_diff = action_logp - old_action_logp
         ratios = act_diff.exp()
         ratios = ratios[:-1]
         # print("diff", act_diff)
 
-        if cfg.algorithm.clip_range_vf > 0:
+        if clip_range_vf > 0:
             # Clip the difference between old and new values
             # NOTE: this depends on the reward scaling
             v_value = old_v_value + torch.clamp(
-                v_value - old_v_value,
-                -cfg.algorithm.clip_range_vf,
-                cfg.algorithm.clip_range_vf,
+                v_value - old_v_value, -clip_range_vf, clip_range_vf
             )
 
-        critic_loss, advantages = compute_advantage_loss(
-            cfg, reward, must_bootstrap, v_value
+        critic_loss, advantages, valid = compute_advantages_loss(
+            done,
+            truncated,
+            v_value,
+            reward,
+            discount_factor,
+            gae_coef,
         )
 
-        actor_loss = compute_actor_loss(
-            advantages.detach(), ratios, cfg.algorithm.clip_range
-        )
+        actor_loss = compute_ppo_actor_loss(advantages, ratios[valid], clip_range)
         # actor_loss = (action_logp[:-1] * advantages.detach()).mean()
 
         # Entropy loss favor exploration
@@ -215,13 +180,10 @@ def run_ppo(cfg):
         logger.log_losses(nb_steps, critic_loss, entropy_loss, actor_loss)
 
         loss = (
-            cfg.algorithm.critic_coef * critic_loss
-            - cfg.algorithm.actor_coef * actor_loss
-            - cfg.algorithm.entropy_coef * entropy_loss
+            critic_coef * critic_loss
+            + actor_coef * actor_loss
+            - entropy_coef * entropy_loss
         )
-        old_policy = copy.deepcopy(train_agent.agent.agents[1])
-        old_train_agent = TemporalAgent(old_policy)
-        old_critic_agent = copy.deepcopy(critic_agent)
         # Calculate approximate form of reverse KL Divergence for early stopping
         # see issue #417: https://github.com/DLR-RM/stable-baselines3/issues/417
         # and discussion in PR #419: https://github.com/DLR-RM/stable-baselines3/pull/419
@@ -244,24 +206,20 @@ def run_ppo(cfg):
         """
         optimizer.zero_grad()
         loss.backward()
-        torch.nn.utils.clip_grad_norm_(
-            critic_agent.parameters(), cfg.algorithm.max_grad_norm
-        )
-        torch.nn.utils.clip_grad_norm_(
-            train_agent.parameters(), cfg.algorithm.max_grad_norm
-        )
+        torch.nn.utils.clip_grad_norm_(parameters, max_grad_norm, foreach=True)
         optimizer.step()
 
         if nb_steps - tmp_steps > cfg.algorithm.eval_interval:
             tmp_steps = nb_steps
-            eval_workspace = Workspace()  # Used for evaluation
-            eval_agent(
-                eval_workspace,
-                t=0,
-                stop_variable="env/done",
-                stochastic=True,
-                predict_proba=False,
-            )
+            eval_workspace.clear()
+            with torch.autocast(device_type, torch.bfloat16, enabled=bf16_rollouts):
+                eval_agent(
+                    eval_workspace,
+                    t=0,
+                    stop_variable="env/done",
+                    stochastic=True,
+                    predict_proba=False,
+                )
             rewards = eval_workspace["env/cumulated_reward"][-1]
             mean = rewards.mean()
             logger.log_reward_losses(rewards, nb_steps)
@@ -280,8 +238,16 @@ def run_ppo(cfg):
                 )
                 eval_agent.save_model(filename)
                 if cfg.plot_agents:
+                    # The plots are only saved to disk: matplotlib and the plotting
+                    # functions are loaded when needed, with a non-interactive backend
+                    import matplotlib
+
+                    matplotlib.use("Agg")
+                    from bbrl.visu.visu_policies import plot_policy
+                    from bbrl.visu.visu_critics import plot_critic
+
                     plot_policy(
-                        eval_agent.agent.agents[1],
+                        traced_policy,
                         eval_env_agent,
                         "./ppo_plots/",
                         cfg.gym_env.env_name,
@@ -289,7 +255,7 @@ def run_ppo(cfg):
                         stochastic=False,
                     )
                     plot_critic(
-                        critic_agent.agent,
+                        eval_agent.agent.agents[1],
                         eval_env_agent,
                         "./ppo_plots/",
                         cfg.gym_env.env_name,
@@ -130,8 +130,6 @@ def run_ppo_clip(cfg):
 
     # We can call the policy instead of a temporal agent because we run on transitions
     policy = train_agent.agent.agents[1]
-    # This is not true of the old_policy, because it works on the train_workspace
-    old_actor = TemporalAgent(old_policy)
 
     train_workspace = Workspace()
 
@@ -149,11 +147,10 @@ def run_ppo_clip(cfg):
             delta_t = 1
             train_workspace.copy_n_last_steps(1)
 
-        # Run the curren actor and evaluate the proba of its action according to the old actor
-        # The old_actor can be run after the train_agent on the same workspace
-        # because it writes a logprob_predict and not an action.
-        # That is, it does not determine the action of the old_actor,
-        # it just determines the proba of the action of the current actor given its own probabilities
+        # Run the current actor, then evaluate the proba of its actions according to the old actor
+        # The old actor does not determine any action,
+        # it just determines the proba of the actions of the current actor
+        # It processes the observations of all the time steps in a single batch
 
         with torch.no_grad():
             train_agent(
@@ -164,14 +161,9 @@ def run_ppo_clip(cfg):
                 predict_proba=False,
                 compute_entropy=False,
             )
-            old_actor(
-                train_workspace,
-                t=delta_t,
-                n_steps=cfg.algorithm.n_steps - delta_t,
-                # Just computes the probability of the current actor's action
-                # to get the ratio of probabilities
-                predict_proba=True,
-                compute_entropy=False,
+            obs, action = train_workspace["env/env_obs", "action"]
+            train_workspace.set_full(
+                "logprob_predict", old_policy.log_prob_batch(obs, action)
             )
 
         # Compute the critic value over the whole workspace
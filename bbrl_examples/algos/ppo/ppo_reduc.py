@@ -137,6 +137,8 @@ def run_ppo_clip(cfg):
 
     # Configure the optimizer
     optimizer = setup_optimizer(cfg, train_agent, critic_agent)
+    # The gradients of the actor and the critic are clipped together
+    parameters = list(train_agent.parameters()) + list(critic_agent.parameters())
 
     # Training loop
     for epoch in range(cfg.algorithm.max_epochs):
@@ -277,12 +279,9 @@ def run_ppo_clip(cfg):
 
             optimizer.zero_grad()
             loss_critic.backward()
-            torch.nn.utils.clip_grad_norm_(
-                critic_agent.parameters(), cfg.algorithm.max_grad_norm
-            )
             loss.backward()
             torch.nn.utils.clip_grad_norm_(
-                policy.parameters(), cfg.algorithm.max_grad_norm
+                parameters, cfg.algorithm.max_grad_norm, foreach=True
             )
             optimizer.step()
 
@@ -0,0 +1,62 @@
+import numba
+import numpy as np
+import torch
+
+# On the CPU the tensors of a rollout are tiny: a compiled loop over the numpy
+# arrays is faster than dispatching one ATen kernel per time step
+
+
+@numba.njit(cache=True, fastmath=True)
+def gae_numba(delta, mb, coef):
+    """Backward recurrence adv[t] = delta[t] + coef * mb[t] * adv[t+1]"""
+    T, N = delta.shape
+    adv = np.empty_like(delta)
+    for n in range(N):
+        last = 0.0
+        for t in range(T - 1, -1, -1):
+            last = delta[t, n] + coef * last * mb[t, n]
+            adv[t, n] = last
+    return adv
+
+
+@numba.njit(cache=True, fastmath=True)
+def gae_numba_backward(grad_adv, mb, coef):
+    """Gradient of gae_numba with respect to delta (a forward recurrence)"""
+    T, N = grad_adv.shape
+    grad_delta = np.empty_like(grad_adv)
+    for n in range(N):
+        last = 0.0
+        for t in range(T):
+            if t > 0:
+                last = last * coef * mb[t - 1, n]
+            last = grad_adv[t, n] + last
+            grad_delta[t, n] = last
+    return grad_delta
+
+
+class GAENumba(torch.autograd.Function):
+    """
+    Differentiable wrapper around gae_numba, so that the critic loss keeps its gradient
+    The recurrences run in the dtype of delta (float32 or float64)
+    """
+
+    @staticmethod
+    def forward(ctx, delta, mb, coef):
+        delta = delta.detach().contiguous()
+        mb = mb.to(delta.dtype).numpy()
+        ctx.mb = mb
+        ctx.coef = coef
+        ctx.dtype = delta.dtype
+        return torch.from_numpy(gae_numba(delta.numpy(), mb, coef))
+
+    @staticmethod
+    def backward(ctx, grad_adv):
+        grad_adv = grad_adv.to(ctx.dtype).contiguous()
+        grad_delta = gae_numba_backward(grad_adv.numpy(), ctx.mb, ctx.coef)
+        return torch.from_numpy(grad_delta), None, None
+
+
+def warmup():
+    """Compile the kernels once, so that the first epoch does not pay for it"""
+    delta = torch.zeros(2, 1, requires_grad=True)
+    GAENumba.apply(delta, torch.ones(2, 1), 0.5).sum().backward()
@@ -0,0 +1,217 @@
+import math
+
+import torch
+import torch.nn as nn
+
+from torch.distributions import Categorical, Independent
+from torch.distributions.normal import Normal
+
+from bbrl_examples.models.actors import BaseActor
+from bbrl_examples.models.policy_helpers import (
+    categorical_action_and_logprob,
+    categorical_log_prob_entropy,
+    gaussian_action_and_logprob,
+    gaussian_log_prob_entropy,
+)
+from bbrl_examples.models.shared_models import build_mlp
+
+
+class ActorCriticShared(nn.Module):
+    """
+    An actor and a critic sharing their first layer: the observations go through
+    a single Linear + GELU trunk which feeds both the policy head and the value head
+    The policy head outputs the action scores (discrete actions)
+    or the mean of a Gaussian policy (continuous actions)
+    The first hidden size of the actor and of the critic is the width of the trunk,
+    so they must be equal
+    forward returns the critic value, forward_both the outputs of the two heads
+    """
+
+    def __init__(
+        self, state_dim, actor_hidden_layers, critic_hidden_layers, action_dim
+    ):
+        super().__init__()
+        if actor_hidden_layers[0] != critic_hidden_layers[0]:
+            raise ValueError(
+                "The actor and the critic share their first layer, their first hidden sizes "
+                f"must be equal (got {actor_hidden_layers[0]} and {critic_hidden_layers[0]})"
+            )
+        trunk_dim = actor_hidden_layers[0]
+        self.trunk = nn.Sequential(nn.Linear(state_dim, trunk_dim), nn.GELU())
+        self.actor_head = build_mlp(
+            list(actor_hidden_layers) + [action_dim], activation=nn.ReLU()
+        )
+        self.critic_head = build_mlp(
+            [trunk_dim] + list(critic_hidden_layers[1:]) + [1], activation=nn.ReLU()
+        )
+
+    def actor_forward(self, obs):
+        return self.actor_head(self.trunk(obs))
+
+    def critic_forward(self, obs):
+        return self.critic_head(self.trunk(obs)).squeeze(-1)
+
+    def forward_both(self, obs):
+        features = self.trunk(obs)
+        return self.actor_head(features), self.critic_head(features).squeeze(-1)
+
+    def forward(self, obs):
+        # Called on its own, the network is the critic, as plot_critic expects
+        return self.critic_forward(obs)
+
+
+class SharedAgent(BaseActor):
+    """
+    An agent writing both the action and the critic value into the workspace
+    from a single pass through an ActorCriticShared network
+    Continuous actions use a Gaussian policy whose variance is modeled as in the actor
+    named by actor_type: tunable through a softplus (TunableVarianceContinuousActor, the default)
+    or constant (ConstantVarianceContinuousActor)
+    """
+
+    def __init__(
+        self,
+        state_dim,
+        actor_hidden_layers,
+        critic_hidden_layers,
+        action_dim,
+        continuous,
+        actor_type=None,
+    ):
+        super().__init__()
+        self.is_q_function = False
+        self.continuous = continuous
+        self.model = ActorCriticShared(
+            state_dim, actor_hidden_layers, critic_hidden_layers, action_dim
+        )
+        if not continuous:
+            supported = (None, "DiscreteActor")
+        else:
+            supported = (
+                None,
+                "TunableVarianceContinuousActor",
+                "ConstantVarianceContinuousActor",
+            )
+        if actor_type not in supported:
+            raise ValueError(f"SharedAgent does not support the {actor_type} actor")
+        self.constant_variance = actor_type == "ConstantVarianceContinuousActor"
+
+        if self.constant_variance:
+            # The same std as a ConstantVarianceContinuousActor
+            self.register_buffer(
+                "const_log_std",
+                torch.full((action_dim,), math.log(2.0)),
+                persistent=False,
+            )
+        elif continuous:
+            init_variance = torch.randn(1, action_dim)
+            self.std_param = nn.parameter.Parameter(init_variance)
+            self.soft_plus = torch.nn.Softplus()
+
+    def log_std(self):
+        if self.constant_variance:
+            return self.const_log_std
+        # std must be positive
+        return torch.log(self.soft_plus(self.std_param[0]))
+
+    def make_distribution(self, policy_out):
+        if self.continuous:
+            return Independent(Normal(policy_out, torch.exp(self.log_std())), 1)
+        return Categorical(logits=policy_out)
+
+    def action_and_logprob(self, policy_out, stochastic):
+        if self.continuous:
+            return gaussian_action_and_logprob(policy_out, self.log_std(), stochastic)
+        return categorical_action_and_logprob(policy_out, stochastic)
+
+    def log_prob_entropy(self, policy_out, action):
+        if self.continuous:
+            return gaussian_log_prob_entropy(action, policy_out, self.log_std())
+        return categorical_log_prob_entropy(policy_out, action)
+
+    def get_distribution(self, obs):
+        policy_out = self.model.actor_forward(obs)
+        return self.make_distribution(policy_out), policy_out
+
+    def best_action(self, policy_out):
+        return policy_out if self.continuous else policy_out.argmax(-1)
+
+    def forward(
+        self,
+        t,
+        stochastic=False,
+        predict_proba=False,
+        compute_entropy=False,
+        critic_only=False,
+        **kwargs,
+    ):
+        """
+        Compute the action and the critic value at time step t
+        If predict_proba is true, the agent takes the action already written in the workspace
+        and adds its probability
+        If critic_only is true, only the critic value is computed
+        """
+        obs = self.get(("env/env_obs", t))
+        # The network may run under autocast (e.g. in bfloat16),
+        # its outputs are brought back to float32 before being used
+        if critic_only:
+            self.set(("v_value", t), self.model.critic_forward(obs).float())
+            return
+
+        policy_out, v_value = self.model.forward_both(obs)
+        policy_out, v_value = policy_out.float(), v_value.float()
+
+        if predict_proba:
+            action = self.get(("action", t))
+            log_prob, entropy = self.log_prob_entropy(policy_out, action)
+            self.set(("logprob_predict", t), log_prob)
+        else:
+            action, log_prob, entropy = self.action_and_logprob(policy_out, stochastic)
+            self.set(("action", t), action)
+            self.set(("action_logprobs", t), log_prob)
+            self.set(("v_value", t), v_value)
+
+        if compute_entropy:
+            self.set(("entropy", t), entropy)
+
+    def predict_action(self, obs, stochastic=False):
+        """Predict just one action (without using the workspace)"""
+        policy_out = self.model.actor_forward(obs)
+        action, _, _ = self.action_and_logprob(policy_out, stochastic)
+        return action
+
+    def predict_value(self, obs):
+        return self.model.critic_forward(obs)
+
+
+class _EagerActor(nn.Module):
+    """The actor of an ActorCriticShared, calling its MLPs without their compiled wrapper"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, obs):
+        return self.model.actor_head.forward(self.model.trunk.forward(obs))
+
+
+class TracedPolicy:
+    """
+    The policy of a SharedAgent, as used by plot_policy which calls predict_action
+    on every point of a grid of observations
+    The deterministic policy is traced with torch.jit.trace the first time it is used
+    The traced module shares the parameters of the agent, so it remains up to date
+    after the optimizer steps and never needs to be traced again
+    """
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.traced_actor = None
+
+    def predict_action(self, obs, stochastic=False):
+        if stochastic:
+            return self.agent.predict_action(obs, stochastic)
+        with torch.no_grad():
+            if self.traced_actor is None:
+                self.traced_actor = torch.jit.trace(_EagerActor(self.agent.model), obs)
+            return self.agent.best_action(self.traced_actor(obs))
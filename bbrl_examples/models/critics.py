@@ -3,7 +3,7 @@ import torch.nn as nn
 
 from bbrl.agents.agent import Agent
 
-from bbrl_examples.models.shared_models import build_mlp, build_alt_mlp
+from bbrl_examples.models.shared_models import build_mlp, build_alt_mlp, maybe_compile
 
 
 class ContinuousQAgent(Agent):
@@ -50,13 +50,48 @@ class DiscreteQAgent(Agent):
         self.model = build_alt_mlp(
             [state_dim] + list(hidden_layers) + [action_dim], activation=nn.ReLU()
         )
+        self._q_values_and_action = self.q_values_and_action
+
+    def __getstate__(self):
+        # A compiled function cannot be copied or saved, the copy runs eagerly
+        state = self.__dict__.copy()
+        state.pop("_q_values_and_action")
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._q_values_and_action = self.q_values_and_action
+
+    def q_values_and_action(self, obs):
+        q_values = self.model(obs).squeeze(-1)
+        return q_values, q_values.argmax(-1)
+
+    def compile_forward(self, obs_dim, *batch_sizes):
+        """
+        Compiles the computation of the Q-values and of the greedy action,
+        the workspace reads and writes remain outside of the compiled graph
+        The graph is specialized and compiled ahead of time for each of the batch sizes
+        """
+        # The default mode is used: CUDA graphs would overwrite the outputs
+        # already written in the workspace at each replay
+        self._q_values_and_action = maybe_compile(
+            self.q_values_and_action, dynamic=False
+        )
+        self._warmup_shapes(obs_dim, batch_sizes)
+
+    def _warmup_shapes(self, obs_dim, batch_sizes):
+        parameter = next(self.model.parameters())
+        for batch_size in batch_sizes:
+            obs = torch.zeros(
+                batch_size, obs_dim, dtype=parameter.dtype, device=parameter.device
+            )
+            self._q_values_and_action(obs)
 
     def forward(self, t, choose_action=True, **kwargs):
         obs = self.get(("env/env_obs", t))
-        q_values = self.model(obs).squeeze(-1)
+        q_values, action = self._q_values_and_action(obs)
         self.set(("q_values", t), q_values)
         if choose_action:
-            action = q_values.argmax(-1)
             self.set(("action", t), action)
 
     def predict_action(self, obs, stochastic):
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 from bbrl import instantiate_class
 
 
@@ -9,6 +10,11 @@ class Logger:
     def add_log(self, log_string, loss, epoch):
         self.logger.add_scalar(log_string, loss.item(), epoch)
 
+    def add_logs(self, log_string, losses, epochs):
+        # All the values are brought back from the device at once
+        for loss, epoch in zip(losses.tolist(), epochs):
+            self.logger.add_scalar(log_string, loss, epoch)
+
     # Log losses
     def log_losses(self, epoch, critic_loss, entropy_loss, actor_loss):
         self.add_log("critic_loss", critic_loss, epoch)
@@ -22,6 +28,36 @@ class Logger:
         self.add_log("reward/median", rewards.median(), nb_steps)
 
 
+class BufferedLog:
+    """
+    Keeps the successive values of a logged quantity on their device,
+    and writes them to the logger every `size` values with a single transfer,
+    so that logging does not wait for the computation of each value
+    """
+
+    def __init__(self, logger, log_string, size):
+        self.logger = logger
+        self.log_string = log_string
+        self.size = size
+        self.values = None
+        self.epochs = []
+
+    def add(self, value, epoch):
+        if self.values is None:
+            self.values = torch.empty(self.size, dtype=value.dtype, device=value.device)
+        self.values[len(self.epochs)] = value.detach()
+        self.epochs.append(epoch)
+        if len(self.epochs) == self.size:
+            self.flush()
+
+    def flush(self):
+        if self.epochs:
+            self.logger.add_logs(
+                self.log_string, self.values[: len(self.epochs)], self.epochs
+            )
+            self.epochs = []
+
+
 class RewardLogger:
     def __init__(self, steps_filename, rewards_filename):
         self.steps_filename = steps_filename
@@ -34,7 +70,8 @@ class RewardLogger:
     def add(self, nb_steps, reward):
         if self.episode == 0:
             self.all_steps.append(nb_steps)
-        self.all_rewards[self.episode].append(reward.item())
+        # The rewards are read back from their device when saved
+        self.all_rewards[self.episode].append(reward.detach())
 
     def new_episode(self):
         self.episode += 1
@@ -42,10 +79,14 @@ class RewardLogger:
 
     def save(self):
         # print("reward loader save:", self.all_steps,  self.all_rewards)
+        all_rewards = [
+            torch.stack(rewards).tolist() if rewards else []
+            for rewards in self.all_rewards
+        ]
         with open(self.steps_filename, "ab") as f:
             np.save(f, self.all_steps)
         with open(self.rewards_filename, "ab") as f:
-            np.save(f, self.all_rewards)
+            np.save(f, all_rewards)
 
 
 class RewardLoader:
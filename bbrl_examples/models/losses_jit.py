@@ -0,0 +1,149 @@
+from typing import Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+from bbrl_examples.models._gae_numba import GAENumba
+from bbrl_examples.models._gae_numba import warmup as warmup_gae_numba
+
+# The losses of A2C and PPO are chains of small pointwise operations over
+# [n_steps, n_envs] tensors, they are scripted so that they run as a single graph
+
+# Above this number of elements, the GAE recurrence of CPU tensors is not run by numba
+NUMBA_MAX_SIZE = 4096
+
+
+@torch.jit.script
+def _td_errors(
+    done: Tensor, truncated: Tensor, v_value: Tensor, reward: Tensor, gamma: float
+) -> Tuple[Tensor, Tensor, Tensor]:
+    # Determines whether values of the critic should be propagated
+    # True if the episode reached a time limit or if the task was not done
+    # See https://colab.research.google.com/drive/1erLbRKvdkdDy0Zn1X_JhC01s1QAt4BBj?usp=sharing
+    # The negation is computed once and sliced for the three masks
+    not_done = ~done
+    must_bootstrap = not_done[1:] | truncated[1:]
+
+    # Compute temporal difference
+    # The value of the next state is a target: no gradient flows through it
+    delta = reward[:-1] + gamma * v_value[1:].detach() * must_bootstrap - v_value[:-1]
+
+    # The advantages are not propagated across the end of an episode, even a truncated one,
+    # and the steps going from the end of an episode to the start of the next one are ignored
+    return delta, not_done[1:], not_done[:-1]
+
+
+@torch.jit.script
+def _gae_scan(delta: Tensor, must_bootstrap: Tensor, coef: float) -> Tensor:
+    advantages = torch.empty_like(delta)
+    last = delta[-1]
+    advantages[-1] = last
+    for t in range(delta.shape[0] - 2, -1, -1):
+        last = delta[t] + coef * last * must_bootstrap[t]
+        advantages[t] = last
+    return advantages
+
+
+@torch.jit.script
+def _gae_conv(delta: Tensor, coef: float) -> Tensor:
+    # A_t = sum_k coef^k delta_{t+k}, computed as a single conv1d over the time dimension
+    # The traces are not cut, which is exact when no episode ends within the rollout
+    length = delta.shape[0]
+    # conv1d computes a cross-correlation, so the weights are not flipped
+    weights = torch.pow(
+        coef, torch.arange(length, device=delta.device, dtype=delta.dtype)
+    )
+    # [T-1, n_envs] -> [n_envs, 1, T-1], padded on the right with T-2 zeros
+    padded = F.pad(delta.transpose(0, 1).unsqueeze(1), [0, length - 1])
+    advantages = F.conv1d(padded, weights.view(1, 1, length))
+    return advantages.squeeze(1).transpose(0, 1)
+
+
+def compute_advantages_loss(
+    done: Tensor,
+    truncated: Tensor,
+    v_value: Tensor,
+    reward: Tensor,
+    gamma: float,
+    lam: float,
+) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Computes the advantages over the [n_steps, n_envs] tensors of a workspace
+    Returns the critic loss, the advantages of the valid steps
+    and the mask selecting these steps among the n_steps - 1 first ones
+    """
+    delta, not_done, valid = _td_errors(done, truncated, v_value, reward, gamma)
+
+    # Compute the advantages with GAE
+    # Small CPU rollouts go through the numba loop. The others go through a single conv1d
+    # when no episode ends within the rollout, and through the scripted loop otherwise
+    if delta.device.type == "cpu" and delta.numel() < NUMBA_MAX_SIZE:
+        advantages = GAENumba.apply(delta, not_done, gamma * lam)
+    elif bool(not_done.all()):
+        advantages = _gae_conv(delta, gamma * lam)
+    else:
+        advantages = _gae_scan(delta, not_done, gamma * lam)
+    advantages = advantages[valid]
+
+    # Compute critic loss
+    critic_loss = (advantages**2).mean()
+    return critic_loss, advantages, valid
+
+
+@torch.jit.script
+def _combine_losses(
+    critic_loss: Tensor,
+    advantages: Tensor,
+    valid: Tensor,
+    action_logp: Tensor,
+    entropy: Tensor,
+    critic_coef: float,
+    entropy_coef: float,
+    a2c_coef: float,
+) -> Tuple[Tensor, Tensor, Tensor]:
+    a2c_loss = (action_logp[:-1][valid] * advantages.detach()).mean()
+    entropy_loss = entropy.mean()
+    loss = critic_coef * critic_loss - entropy_coef * entropy_loss - a2c_coef * a2c_loss
+    return a2c_loss, entropy_loss, loss
+
+
+def compute_losses(
+    done: Tensor,
+    truncated: Tensor,
+    v_value: Tensor,
+    reward: Tensor,
+    action_logp: Tensor,
+    entropy: Tensor,
+    gamma: float,
+    lam: float,
+    critic_coef: float,
+    entropy_coef: float,
+    a2c_coef: float,
+) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+    """Returns the critic, actor and entropy losses of A2C and their combination"""
+    critic_loss, advantages, valid = compute_advantages_loss(
+        done, truncated, v_value, reward, gamma, lam
+    )
+    a2c_loss, entropy_loss, loss = _combine_losses(
+        critic_loss,
+        advantages,
+        valid,
+        action_logp,
+        entropy,
+        critic_coef,
+        entropy_coef,
+        a2c_coef,
+    )
+    return critic_loss, a2c_loss, entropy_loss, loss
+
+
+@torch.jit.script
+def compute_ppo_actor_loss(advantages: Tensor, ratio: Tensor, clip: float) -> Tensor:
+    """Returns the (negated) PPO clipped surrogate, with normalized advantages"""
+    adv = advantages.detach()
+    adv = adv - adv.mean()
+    # The std of a single advantage is NaN, while once centered it is already 0
+    if adv.numel() > 1:
+        adv = adv / (adv.std() + 1e-8)
+    return -torch.minimum(adv * ratio, adv * ratio.clamp(1 - clip, 1 + clip)).mean()
@@ -0,0 +1,26 @@
+import torch
+
+from bbrl import get_arguments, get_class
+
+
+def create_optimizer(optimizer_cfg, parameters):
+    """
+    Create the optimizer described by optimizer_cfg, using the fused (CUDA)
+    or foreach implementation of Adam and AdamW so that each step updates
+    all the parameters at once instead of looping over them
+    The arguments given in the configuration take precedence
+    """
+    parameters = list(parameters)
+    optimizer_class = get_class(optimizer_cfg)
+    optimizer_args = get_arguments(optimizer_cfg)
+    if issubclass(optimizer_class, (torch.optim.Adam, torch.optim.AdamW)):
+        if all(p.is_cuda for p in parameters):
+            vectorized_args = {"fused": True}
+        else:
+            vectorized_args = {"foreach": True}
+        try:
+            return optimizer_class(parameters, **{**vectorized_args, **optimizer_args})
+        except (TypeError, RuntimeError):
+            # Older versions of PyTorch do not provide these implementations
+            pass
+    return optimizer_class(parameters, **optimizer_args)
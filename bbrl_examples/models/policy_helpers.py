@@ -0,0 +1,97 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from bbrl_examples.models.shared_models import maybe_compile
+
+# The actors compute their action, its log probability and the entropy of the policy
+# at each time step. Building a torch.distributions object for that costs more
+# than the small MLPs themselves, so these helpers use the closed-form expressions
+# on plain tensors, which torch.compile turns into a single graph
+
+HALF_LOG_2PI = 0.5 * math.log(2 * math.pi)
+
+
+def _compile(fn):
+    return maybe_compile(fn, dynamic=False)
+
+
+@_compile
+def gaussian_logprob(x, mean, log_std):
+    """
+    Log density of x under a diagonal Gaussian, summed over the action dimensions
+    The std is given by its log, so that it is never exponentiated then logged again
+    """
+    z = (x - mean) * torch.exp(-log_std)
+    return (-0.5 * z**2 - log_std - HALF_LOG_2PI).sum(-1)
+
+
+@_compile
+def gaussian_log_prob_entropy(action, mean, log_std):
+    """
+    Log probability of the action and entropy of a diagonal Gaussian policy,
+    summed over the action dimensions
+    """
+    entropy = (0.5 + HALF_LOG_2PI + log_std).expand_as(mean).sum(-1)
+    return gaussian_logprob(action, mean, log_std), entropy
+
+
+@_compile
+def gaussian_action_and_logprob(mean, log_std, stochastic: bool):
+    """
+    Action of a diagonal Gaussian policy (sampled or the mean),
+    with its log probability and the entropy of the policy
+    """
+    if stochastic:
+        # As with Distribution.sample(), no gradient flows through the action
+        action = (mean + torch.exp(log_std) * torch.randn_like(mean)).detach()
+    else:
+        action = mean
+    log_prob, entropy = gaussian_log_prob_entropy(action, mean, log_std)
+    return action, log_prob, entropy
+
+
+@_compile
+def categorical_log_prob_entropy(scores, action):
+    """Log probability of the action and entropy of a softmax policy over the scores"""
+    log_probs = F.log_softmax(scores, dim=-1)
+    log_prob = log_probs.gather(-1, action.unsqueeze(-1)).squeeze(-1)
+    entropy = -(log_probs.exp() * log_probs).sum(-1)
+    return log_prob, entropy
+
+
+@_compile
+def categorical_action_and_logprob(scores, stochastic: bool):
+    """
+    Action of a softmax policy over the scores (sampled or the argmax),
+    with its log probability and the entropy of the policy
+    """
+    log_probs = F.log_softmax(scores, dim=-1)
+    if stochastic:
+        action = torch.multinomial(log_probs.exp(), 1).squeeze(-1)
+    else:
+        action = scores.argmax(-1)
+    log_prob = log_probs.gather(-1, action.unsqueeze(-1)).squeeze(-1)
+    entropy = -(log_probs.exp() * log_probs).sum(-1)
+    return action, log_prob, entropy
+
+
+@_compile
+def bernoulli_action_and_logprob(logits, stochastic: bool):
+    """
+    Binary action of a Bernoulli policy given by its logits (sampled, or 1 when its probability
+    is below 0.5), with its log probability and the entropy of the policy
+    """
+    if stochastic:
+        action = (torch.sigmoid(logits) > torch.rand_like(logits)).int()
+    else:
+        action = (logits < 0).int()
+    log_prob = -F.binary_cross_entropy_with_logits(
+        logits, action.float(), reduction="none"
+    )
+    entropy = -(
+        torch.sigmoid(logits) * F.logsigmoid(logits)
+        + torch.sigmoid(-logits) * F.logsigmoid(-logits)
+    )
+    return action, log_prob, entropy
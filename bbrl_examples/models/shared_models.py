@@ -1,6 +1,12 @@
+import sys
+
 import numpy as np
+import torch
 import torch.nn as nn
 
+# torch.compile relies on Triton, which is not available on Windows
+CAN_COMPILE = sys.platform != "win32"
+
 
 def ortho_init(layer, std=np.sqrt(2), bias_const=0.0):
     """
@@ -65,3 +71,22 @@ def build_ortho_alt_mlp(sizes, activation):
 def soft_update_params(net, target_net, tau):
     for param, target_param in zip(net.parameters(), target_net.parameters()):
         target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
+
+
+def compile_mlps(agent, **kwargs):
+    """
+    Compile in place the MLPs of an agent, leaving its workspace reads and writes
+    (which would break the graph) uncompiled
+    """
+    if not CAN_COMPILE:
+        return
+    for module in agent.modules():
+        if isinstance(module, nn.Sequential):
+            module.compile(**kwargs)
+
+
+def maybe_compile(fn, **kwargs):
+    """torch.compile fn, or return it unchanged where torch.compile is not available"""
+    if not CAN_COMPILE:
+        return fn
+    return torch.compile(fn, **kwargs)
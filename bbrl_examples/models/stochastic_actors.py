@@ -1,12 +1,25 @@
+import math
+from typing import List, Tuple
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
 
 from bbrl_examples.models.actors import BaseActor
 
 from torch.distributions.normal import Normal
-from torch.distributions import Bernoulli, Independent
+from torch.distributions import Independent
 from bbrl.utils.distributions import SquashedDiagGaussianDistribution
 
+from bbrl_examples.models.policy_helpers import (
+    bernoulli_action_and_logprob,
+    categorical_action_and_logprob,
+    categorical_log_prob_entropy,
+    gaussian_action_and_logprob,
+    gaussian_log_prob_entropy,
+    gaussian_logprob,
+)
 from bbrl_examples.models.shared_models import (
     build_mlp,
     build_backbone,
@@ -16,6 +29,20 @@ from bbrl_examples.models.shared_models import (
 
 from bbrl.agents.agent import Agent
 
+# Checking the outputs for NaNs reads them back on the host at every step,
+# which synchronizes with the GPU: it is only done when debugging
+DEBUG_NAN = False
+
+# On CPU, where torch.compile brings less, the actors having a TorchScript version
+# of their forward pass use it. Set to False to run their (possibly compiled) modules
+TORCHSCRIPT_ON_CPU = True
+
+
+def sample_categorical(probs):
+    """Sample one action per row of probs, whatever its leading dimensions"""
+    flat_probs = probs.reshape(-1, probs.shape[-1])
+    return torch.multinomial(flat_probs, 1).view(probs.shape[:-1])
+
 
 class ActorAgent(Agent):
     """Choose an action (either according to p(a_t|s_t) when stochastic is true,
@@ -28,7 +55,7 @@ class ActorAgent(Agent):
     def forward(self, t, stochastic, **kwargs):
         probs = self.get(("action_probs", t))
         if stochastic:
-            action = torch.distributions.Categorical(probs).sample()
+            action = sample_categorical(probs)
         else:
             action = probs.argmax(1)
 
@@ -39,34 +66,23 @@ class BernoulliActor(Agent):
     def __init__(self, state_dim, hidden_layers):
         super().__init__()
         layers = [state_dim] + list(hidden_layers) + [1]
+        # The model outputs the logit of the probability of action 1
         self.model = build_mlp(
-            layers, activation=nn.ReLU(), output_activation=nn.Sigmoid()
+            layers, activation=nn.ReLU(), output_activation=nn.Identity()
         )
 
     def forward(self, t, stochastic=False, **kwargs):
         obs = self.get(("env/env_obs", t))
-        mean = self.model(obs)
-        dist = Bernoulli(mean)
-        self.set(("entropy", t), dist.entropy())
-        if stochastic:
-            action = dist.sample().int().squeeze(-1)
-        else:
-            act = mean.lt(0.5)
-            action = act.squeeze(-1)
-        # print(f"stoch:{stochastic} obs:{obs} mean:{mean} dist:{dist} action:{action}")
-        log_prob = dist.log_prob(action.float()).sum(axis=-1)
+        logits = self.model(obs).squeeze(-1)
+        action, log_prob, entropy = bernoulli_action_and_logprob(logits, stochastic)
+        self.set(("entropy", t), entropy)
         self.set(("action", t), action)
         self.set(("action_logprobs", t), log_prob)
 
     def predict_action(self, obs, stochastic=False):
-        mean = self.model(obs)
-        dist = Bernoulli(mean)
-        if stochastic:
-            act = dist.sample().int()
-            return act
-        else:
-            act = mean.lt(0.5)
-        return act
+        logits = self.model(obs)
+        action, _, _ = bernoulli_action_and_logprob(logits, stochastic)
+        return action
 
 
 class ProbAgent(Agent):
@@ -79,10 +95,13 @@ class ProbAgent(Agent):
     def forward(self, t, **kwargs):
         observation = self.get(("env/env_obs", t))
         scores = self.model(observation)
-        action_probs = torch.softmax(scores, dim=-1)
-        assert not torch.any(torch.isnan(action_probs)), "Nan Here"
+        # The log-probabilities are computed once and used for both outputs
+        log_probs = F.log_softmax(scores, dim=-1)
+        action_probs = log_probs.exp()
+        if DEBUG_NAN:
+            assert not torch.any(torch.isnan(action_probs)), "Nan Here"
         self.set(("action_probs", t), action_probs)
-        entropy = torch.distributions.Categorical(action_probs).entropy()
+        entropy = -(action_probs * log_probs).sum(-1)
         self.set(("entropy", t), entropy)
 
 
@@ -93,7 +112,7 @@ class ActionAgent(Agent):
     def forward(self, t, stochastic, **kwargs):
         probs = self.get(("action_probs", t))
         if stochastic:
-            action = torch.distributions.Categorical(probs).sample()
+            action = sample_categorical(probs)
         else:
             action = probs.argmax(1)
 
@@ -109,8 +128,7 @@ class DiscreteActor(BaseActor):
 
     def get_distribution(self, obs):
         scores = self.model(obs)
-        probs = torch.softmax(scores, dim=-1)
-        return torch.distributions.Categorical(probs), scores
+        return torch.distributions.Categorical(logits=scores), scores
 
     def forward(
         self, t, stochastic=False, predict_proba=False, compute_entropy=False, **kwargs
@@ -125,37 +143,37 @@ class DiscreteActor(BaseActor):
             observation = kwargs["observation"]
         else:
             observation = self.get(("env/env_obs", t))
-        dist, scores = self.get_distribution(observation)
-        probs = torch.softmax(scores, dim=-1)
-
-        if compute_entropy:
-            entropy = dist.entropy()
-            self.set(("entropy", t), entropy)
+        scores = self.model(observation)
 
         if predict_proba:
             action = self.get(("action", t))
-            log_prob = probs[torch.arange(probs.size()[0]), action].log()
+            log_prob, entropy = categorical_log_prob_entropy(scores, action)
             self.set(("logprob_predict", t), log_prob)
         else:
-            if stochastic:
-                action = dist.sample()
-            else:
-                action = scores.argmax(1)
-
-            log_probs = probs[torch.arange(probs.size()[0]), action].log()
-
+            action, log_prob, entropy = categorical_action_and_logprob(
+                scores, stochastic
+            )
             self.set(("action", t), action)
-            self.set(("action_logprobs", t), log_probs)
+            self.set(("action_logprobs", t), log_prob)
 
-    def predict_action(self, obs, stochastic=False):
-        dist, scores = self.get_distribution(obs)
+        if compute_entropy:
+            self.set(("entropy", t), entropy)
 
-        if stochastic:
-            action = dist.sample()
-        else:
-            action = scores.argmax(0)
+    def predict_action(self, obs, stochastic=False):
+        scores = self.model(obs)
+        action, _, _ = categorical_action_and_logprob(scores, stochastic)
         return action
 
+    def log_prob_batch(self, obs, action):
+        """
+        Compute the log probabilities of the [n_steps, n_envs] actions of a workspace
+        with a single forward pass over all the observations
+        """
+        n_steps, n_envs = obs.shape[:2]
+        dist, _ = self.get_distribution(obs.reshape(n_steps * n_envs, -1))
+        log_prob = dist.log_prob(action.reshape(n_steps * n_envs))
+        return log_prob.reshape(n_steps, n_envs)
+
 
 # All the actors below use a Gaussian policy, that is the output is Normal distribution
 
@@ -196,68 +214,241 @@ class StochasticActor(BaseActor):
         dist, mean = self.get_distribution(obs)
         return dist.sample() if stochastic else mean
 
+    def log_prob_batch(self, obs, action):
+        """
+        Compute the log probabilities of the [n_steps, n_envs] actions of a workspace
+        with a single forward pass over all the observations
+        """
+        n_steps, n_envs = obs.shape[:2]
+        dist, _ = self.get_distribution(obs.reshape(n_steps * n_envs, -1))
+        log_prob = dist.log_prob(action.reshape(n_steps * n_envs, -1))
+        return log_prob.reshape(n_steps, n_envs)
 
-class TunableVarianceContinuousActor(StochasticActor):
-    def __init__(self, state_dim, hidden_layers, action_dim):
+
+def _merge_heads(actor):
+    """
+    Replaces the separate mean and std layers of an actor pickled
+    before they were merged by a single last_head holding their weights
+    """
+    if "last_mean_layer" not in actor._modules:
+        return
+    mean_layer = actor._modules.pop("last_mean_layer")
+    std_layer = actor._modules.pop("last_std_layer")
+    last_head = nn.Linear(
+        mean_layer.in_features,
+        mean_layer.out_features + std_layer.out_features,
+        device=mean_layer.weight.device,
+        dtype=mean_layer.weight.dtype,
+    )
+    with torch.no_grad():
+        last_head.weight.copy_(torch.cat([mean_layer.weight, std_layer.weight]))
+        last_head.bias.copy_(torch.cat([mean_layer.bias, std_layer.bias]))
+    actor.last_head = last_head
+
+
+class DiagGaussianActor(StochasticActor):
+    """
+    A Gaussian policy with a diagonal covariance
+    The subclasses only compute the mean and the log of the std of the policy,
+    the action, its log probability and the entropy are computed by compiled helpers
+    The Linear layers of the network may hold their parameters in a lower precision
+    such as bfloat16 (dtype argument), the observations are cast to it and the mean
+    and log std are brought back to float32, so that the workspace and the losses
+    only see float32 tensors. The std parameters and buffers always stay in float32
+    """
+
+    dtype = torch.float32
+
+    def set_dtype(self, dtype):
+        self.dtype = dtype
+        for module in self.modules():
+            if isinstance(module, nn.Linear):
+                module.to(dtype)
+
+    def get_mean_log_std(self, obs: torch.Tensor):
+        raise NotImplementedError
+
+    def use_torchscript(self, obs: torch.Tensor):
+        # The scripted forward passes are only used for float32 networks
+        return (
+            TORCHSCRIPT_ON_CPU
+            and obs.device.type == "cpu"
+            and self.dtype == torch.float32
+        )
+
+    def mean_log_std(self, obs: torch.Tensor):
+        mean, log_std = self.get_mean_log_std(obs.to(self.dtype))
+        return mean.float(), log_std.float()
+
+    def get_distribution(self, obs: torch.Tensor):
+        mean, log_std = self.mean_log_std(obs)
+        return Independent(Normal(mean, torch.exp(log_std)), 1), mean
+
+    def forward(
+        self, t, stochastic=False, predict_proba=False, compute_entropy=False, **kwargs
+    ):
+        obs = self.get(("env/env_obs", t))
+        mean, log_std = self.mean_log_std(obs)
+
+        if predict_proba:
+            action = self.get(("action", t))
+            log_prob, entropy = gaussian_log_prob_entropy(action, mean, log_std)
+            self.set(("logprob_predict", t), log_prob)
+        else:
+            action, log_prob, entropy = gaussian_action_and_logprob(
+                mean, log_std, stochastic
+            )
+            self.set(("action", t), action)
+            self.set(("action_logprobs", t), log_prob)
+
+        if compute_entropy:
+            self.set(("entropy", t), entropy)
+
+
+class TunableVarianceContinuousActor(DiagGaussianActor):
+    def __init__(self, state_dim, hidden_layers, action_dim, dtype=torch.float32):
         super().__init__()
         layers = [state_dim] + list(hidden_layers) + [action_dim]
         self.model = build_mlp(layers, activation=nn.ReLU())
         init_variance = torch.randn(action_dim, 1).transpose(0, 1)
         self.std_param = nn.parameter.Parameter(init_variance)
         self.soft_plus = torch.nn.Softplus()
+        self.set_dtype(dtype)
 
-    def get_distribution(self, obs: torch.Tensor):
+    def get_mean_log_std(self, obs: torch.Tensor):
         mean = self.model(obs)
-        # std must be positive
-        return Independent(Normal(mean, self.soft_plus(self.std_param[:, 0])), 1), mean
+        # std must be positive, its log is computed once per forward
+        return mean, torch.log(self.soft_plus(self.std_param.view(-1)))
+
+
+def _linear_params(modules) -> Tuple[List[Tensor], List[Tensor]]:
+    linears = [m for m in modules if isinstance(m, nn.Linear)]
+    return [m.weight for m in linears], [m.bias for m in linears]
+
+
+@torch.jit.script
+def _tanh_mlp(
+    x: Tensor, weights: List[Tensor], biases: List[Tensor], output_tanh: bool
+) -> Tensor:
+    for i in range(len(weights)):
+        x = F.linear(x, weights[i], biases[i])
+        if output_tanh or i < len(weights) - 1:
+            x = torch.tanh(x)
+    return x
 
 
-class TunableVarianceContinuousActorExp(StochasticActor):
+@torch.jit.script
+def exp_actor_mean_log_std(
+    obs: Tensor, weights: List[Tensor], biases: List[Tensor], std_param: Tensor
+) -> Tuple[Tensor, Tensor]:
+    """TorchScript forward pass of a TunableVarianceContinuousActorExp"""
+    return _tanh_mlp(obs, weights, biases, False), torch.clamp(std_param, -20.0, 2.0)
+
+
+@torch.jit.script
+def state_dependent_mean_log_std(
+    obs: Tensor,
+    weights: List[Tensor],
+    biases: List[Tensor],
+    head_weight: Tensor,
+    head_bias: Tensor,
+) -> Tuple[Tensor, Tensor]:
+    """TorchScript forward pass of a StateDependentVarianceContinuousActor"""
+    backbone_output = _tanh_mlp(obs, weights, biases, True)
+    mean, log_std = F.linear(backbone_output, head_weight, head_bias).chunk(2, dim=-1)
+    return mean, log_std.clamp(-20.0, 2.0)
+
+
+class TunableVarianceContinuousActorExp(DiagGaussianActor):
     """
     A variant of the TunableVarianceContinuousActor class where, instead of using a softplus on the std,
     we exponentiate it
     """
 
-    def __init__(self, state_dim, hidden_layers, action_dim):
+    def __init__(self, state_dim, hidden_layers, action_dim, dtype=torch.float32):
         super().__init__()
         layers = [state_dim] + list(hidden_layers) + [action_dim]
         self.model = build_mlp(layers, activation=nn.Tanh())
         self.std_param = nn.parameter.Parameter(torch.randn(1, action_dim))
+        self.set_dtype(dtype)
 
-    def get_distribution(self, obs: torch.Tensor):
+    def get_mean_log_std(self, obs: torch.Tensor):
+        # std_param already holds the log of the std
+        if self.use_torchscript(obs):
+            weights, biases = _linear_params(self.model)
+            return exp_actor_mean_log_std(obs, weights, biases, self.std_param)
         mean = self.model(obs)
-        std = torch.clamp(self.std_param, -20, 2)
-        return Independent(Normal(mean, torch.exp(std)), 1), mean
+        return mean, torch.clamp(self.std_param, -20, 2)
 
 
-class StateDependentVarianceContinuousActor(StochasticActor):
-    def __init__(self, state_dim, hidden_layers, action_dim):
+class StateDependentVarianceContinuousActor(DiagGaussianActor):
+    def __init__(self, state_dim, hidden_layers, action_dim, dtype=torch.float32):
         super().__init__()
         backbone_dim = [state_dim] + list(hidden_layers)
         self.layers = build_backbone(backbone_dim, activation=nn.Tanh())
         self.backbone = nn.Sequential(*self.layers)
 
-        self.last_mean_layer = nn.Linear(hidden_layers[-1], action_dim)
-        self.last_std_layer = nn.Linear(hidden_layers[-1], action_dim)
-
-    def get_distribution(self, obs: torch.Tensor):
+        # The mean and the log of the std are computed by a single layer
+        self.last_head = nn.Linear(hidden_layers[-1], 2 * action_dim)
+        self.set_dtype(dtype)
+
+    def __setstate__(self, state):
+        # The agents are saved whole with torch.save, older ones have two head layers
+        super().__setstate__(state)
+        _merge_heads(self)
+
+    def get_mean_log_std(self, obs: torch.Tensor):
+        if self.use_torchscript(obs):
+            weights, biases = _linear_params(self.layers)
+            return state_dependent_mean_log_std(
+                obs, weights, biases, self.last_head.weight, self.last_head.bias
+            )
         backbone_output = self.backbone(obs)
-        mean = self.last_mean_layer(backbone_output)
-        std_out = self.last_std_layer(backbone_output)
-        std = torch.exp(std_out)
-        return Independent(Normal(mean, std), 1), mean
+        mean, log_std = self.last_head(backbone_output).chunk(2, dim=-1)
+        # The std stays in log scale, clamped as in the SquashedGaussianActor
+        return mean, log_std.clamp(-20, 2)
 
 
-class ConstantVarianceContinuousActor(StochasticActor):
-    def __init__(self, state_dim, hidden_layers, action_dim):
+class ConstantVarianceContinuousActor(DiagGaussianActor):
+    def __init__(self, state_dim, hidden_layers, action_dim, dtype=torch.float32):
         super().__init__()
         layers = [state_dim] + list(hidden_layers) + [action_dim]
         self.model = build_mlp(layers, activation=nn.Tanh())
         self.std_param = 2
+        self.register_buffer(
+            "log_std", torch.tensor(math.log(self.std_param)), persistent=False
+        )
+        # The std being fixed, so is the entropy of the policy
+        self._const_entropy = (
+            0.5 * math.log(2 * math.pi * math.e * self.std_param**2) * action_dim
+        )
+        self.set_dtype(dtype)
 
-    def get_distribution(self, obs: torch.Tensor):
-        mean = self.model(obs)
-        return Normal(mean, self.std_param), mean
+    def get_mean_log_std(self, obs: torch.Tensor):
+        return self.model(obs), self.log_std
+
+    def forward(
+        self, t, stochastic=False, predict_proba=False, compute_entropy=False, **kwargs
+    ):
+        obs = self.get(("env/env_obs", t))
+        mean, log_std = self.mean_log_std(obs)
+
+        if predict_proba:
+            action = self.get(("action", t))
+            self.set(("logprob_predict", t), gaussian_logprob(action, mean, log_std))
+        else:
+            if stochastic:
+                # As with Distribution.sample(), no gradient flows through the action
+                action = (mean + self.std_param * torch.randn_like(mean)).detach()
+            else:
+                action = mean
+            self.set(("action", t), action)
+            self.set(("action_logprobs", t), gaussian_logprob(action, mean, log_std))
+
+        if compute_entropy:
+            self.set(
+                ("entropy", t), mean.new_full(mean.shape[:-1], self._const_entropy)
+            )
 
 
 class SquashedGaussianActor(StochasticActor):
@@ -266,38 +457,43 @@ class SquashedGaussianActor(StochasticActor):
         backbone_dim = [state_dim] + list(hidden_layers)
         self.layers = build_backbone(backbone_dim, activation=nn.Tanh())
         self.backbone = nn.Sequential(*self.layers)
-        self.last_mean_layer = nn.Linear(hidden_layers[-1], action_dim)
-        self.last_std_layer = nn.Linear(hidden_layers[-1], action_dim)
+        # The mean and the log of the std are computed by a single layer
+        self.last_head = nn.Linear(hidden_layers[-1], 2 * action_dim)
         self.action_dist = SquashedDiagGaussianDistribution(action_dim)
 
+    def __setstate__(self, state):
+        # The agents are saved whole with torch.save, older ones have two head layers
+        super().__setstate__(state)
+        _merge_heads(self)
+
     def get_distribution(self, obs: torch.Tensor):
         backbone_output = self.backbone(obs)
-        mean = self.last_mean_layer(backbone_output)
-        std_out = self.last_std_layer(backbone_output)
+        mean, log_std = self.last_head(backbone_output).chunk(2, dim=-1)
 
-        std_out = std_out.clamp(-20, 2)  # as in the official code
-        std = torch.exp(std_out)
-        return self.action_dist.make_distribution(mean, std), mean
+        log_std = log_std.clamp(-20, 2)  # as in the official code
+        # The distribution takes the log of the std, and exponentiates it itself
+        return self.action_dist.make_distribution(mean, log_std), mean
 
     def test(self, obs, action):
         action_dist = self.get_distribution(obs)
         return action_dist.log_prob(action)
 
 
-class TunableVariancePPOActor(StochasticActor):
+class TunableVariancePPOActor(DiagGaussianActor):
     """
     The official PPO actor uses Tanh activation functions and orthogonal initialization
     """
 
-    def __init__(self, state_dim, hidden_layers, action_dim):
+    def __init__(self, state_dim, hidden_layers, action_dim, dtype=torch.float32):
         super().__init__()
         layers = [state_dim] + list(hidden_layers) + [action_dim]
         self.model = build_ortho_mlp(layers, activation=nn.Tanh())
         init_variance = torch.randn(1, action_dim)
         self.std_param = nn.parameter.Parameter(init_variance)
         self.soft_plus = torch.nn.Softplus()
+        self.set_dtype(dtype)
 
-    def get_distribution(self, obs: torch.Tensor):
+    def get_mean_log_std(self, obs: torch.Tensor):
         mean = self.model(obs)
-        # std must be positive
-        return Independent(Normal(mean, self.soft_plus(self.std_param[:, 0])), 1), mean
+        # std must be positive, its log is computed once per forward
+        return mean, torch.log(self.soft_plus(self.std_param.view(-1)))
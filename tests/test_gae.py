@@ -0,0 +1,77 @@
+import pytest
+import torch
+
+from bbrl_examples.models import losses_jit
+from bbrl_examples.models._gae_numba import GAENumba
+from bbrl_examples.models.losses_jit import (
+    _gae_conv,
+    _gae_scan,
+    _td_errors,
+    compute_advantages_loss,
+)
+
+GAMMA = 0.95
+LAM = 0.8
+
+
+def make_rollout(with_done, n_steps=20, n_envs=4, dtype=torch.float32):
+    torch.manual_seed(0)
+    done = torch.zeros(n_steps, n_envs, dtype=torch.bool)
+    truncated = torch.zeros(n_steps, n_envs, dtype=torch.bool)
+    if with_done:
+        # A terminal state and a time limit in the middle of the traces
+        done[7, 1] = True
+        done[12, 3] = True
+        truncated[12, 3] = True
+    v_value = torch.randn(n_steps, n_envs, dtype=dtype)
+    reward = torch.randn(n_steps, n_envs, dtype=dtype)
+    return done, truncated, v_value, reward
+
+
+def reference_gae(delta, not_done, coef):
+    advantages = torch.zeros_like(delta)
+    last = torch.zeros_like(delta[0])
+    for t in range(delta.shape[0] - 1, -1, -1):
+        last = delta[t] + coef * last * not_done[t]
+        advantages[t] = last
+    return advantages
+
+
+@pytest.mark.parametrize("with_done", [False, True])
+def test_gae_kernels_agree(with_done):
+    done, truncated, v_value, reward = make_rollout(with_done)
+    delta, not_done, _ = _td_errors(done, truncated, v_value, reward, GAMMA)
+    expected = reference_gae(delta, not_done, GAMMA * LAM)
+
+    torch.testing.assert_close(_gae_scan(delta, not_done, GAMMA * LAM), expected)
+    torch.testing.assert_close(GAENumba.apply(delta, not_done, GAMMA * LAM), expected)
+    if not with_done:
+        # The conv1d does not cut the traces, it is only used without episode ends
+        torch.testing.assert_close(_gae_conv(delta, GAMMA * LAM), expected)
+
+
+@pytest.mark.parametrize("with_done", [False, True])
+@pytest.mark.parametrize("numba_max_size", [0, 10**9])
+def test_compute_advantages_loss_paths(monkeypatch, with_done, numba_max_size):
+    # numba_max_size selects the numba path (large) or the conv1d / scan ones (0)
+    monkeypatch.setattr(losses_jit, "NUMBA_MAX_SIZE", numba_max_size)
+    done, truncated, v_value, reward = make_rollout(with_done)
+    _, advantages, valid = compute_advantages_loss(
+        done, truncated, v_value, reward, GAMMA, LAM
+    )
+
+    delta, not_done, expected_valid = _td_errors(
+        done, truncated, v_value, reward, GAMMA
+    )
+    expected = reference_gae(delta, not_done, GAMMA * LAM)[expected_valid]
+    assert torch.equal(valid, expected_valid)
+    torch.testing.assert_close(advantages, expected)
+
+
+def test_gae_numba_gradcheck():
+    torch.manual_seed(0)
+    delta = torch.randn(6, 3, dtype=torch.float64, requires_grad=True)
+    not_done = torch.rand(6, 3) > 0.3
+    assert torch.autograd.gradcheck(
+        lambda x: GAENumba.apply(x, not_done, GAMMA * LAM), (delta,)
+    )